@@ -1,21 +1,66 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
 from fastapi.responses import HTMLResponse, JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Dict, List
-import json
+import asyncio
+import os
 import uuid
+
+import msgpack
+import orjson
 from models import Base, FormData, SessionLocal, engine
 
+# When REDIS_URL is set, form-update broadcasts go through Redis pub/sub
+# so multiple workers (or nodes) can share a room's form state; unset,
+# fan-out stays in-process. Presence (user_list) and field locks live in
+# per-worker memory either way and are only delivered to local sockets,
+# so exact lock/presence semantics need a single worker.
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+
 app = FastAPI()
 
+# One Packer for the whole event loop; it reuses its internal buffer
+# instead of allocating a fresh one per msgpack.packb call.
+_packer = msgpack.Packer(use_bin_type=True)
+
+def pack_message(message: dict, use_msgpack: bool) -> bytes:
+    return _packer.pack(message) if use_msgpack else orjson.dumps(message)
+
+def unpack_message(data, use_msgpack: bool) -> dict:
+    return msgpack.unpackb(data, raw=False) if use_msgpack else orjson.loads(data)
+
 # Ensure database tables are created
-Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Keep strong references; the loop only holds weak ones.
+    app.state.background_tasks = [
+        asyncio.create_task(manager.flush_loop()),
+        asyncio.create_task(manager.user_list_loop()),
+    ]
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    # Persist anything still dirty so a graceful restart loses nothing.
+    await manager.flush_all()
 
 html = """
 <!DOCTYPE html>
 <html>
     <head>
         <title>Real-time Form Collaboration</title>
+        <script src="https://unpkg.com/@msgpack/msgpack@3/dist.umd/msgpack.min.js"></script>
     </head>
     <body>
         <h1>Real-time Form Collaboration</h1>
@@ -64,12 +109,27 @@ html = """
             function connectToForm(formId, userId) {
                 const form = document.getElementById('collabForm');
                 form.style.display = 'block';
-                const ws = new WebSocket(`wss://${location.host}/ws/${formId}/${userId}`);
+                const ws = new WebSocket(`wss://${location.host}/ws/${formId}/${userId}`, 'msgpack');
+                ws.binaryType = 'arraybuffer';
+
+                function encodeMessage(message) {
+                    return ws.protocol === 'msgpack' ? MessagePack.encode(message) : JSON.stringify(message);
+                }
+
+                function decodeMessage(eventData) {
+                    if (typeof eventData === 'string') {
+                        return JSON.parse(eventData);
+                    }
+                    if (ws.protocol === 'msgpack') {
+                        return MessagePack.decode(new Uint8Array(eventData));
+                    }
+                    return JSON.parse(new TextDecoder().decode(eventData));
+                }
 
                 let editingField = null;
 
                 ws.onmessage = function(event) {
-                    const data = JSON.parse(event.data);
+                    const data = decodeMessage(event.data);
                     if (data.type === 'update') {
                         for (let key in data.payload) {
                             if (form.elements[key]) {
@@ -100,23 +160,23 @@ html = """
                     const formData = new FormData(form);
                     const data = {};
                     formData.forEach((value, key) => data[key] = value);
-                    ws.send(JSON.stringify({ type: 'update', user_id: userId, payload: data }));
+                    ws.send(encodeMessage({ type: 'update', user_id: userId, payload: data }));
                 });
 
                 form.addEventListener('focusin', function(event) {
                     if (editingField === event.target.name) return;
                     editingField = event.target.name;
-                    ws.send(JSON.stringify({ type: 'lock', user_id: userId, payload: { field: editingField } }));
+                    ws.send(encodeMessage({ type: 'lock', user_id: userId, payload: { field: editingField } }));
                 });
 
                 form.addEventListener('focusout', function(event) {
                     if (editingField !== event.target.name) return;
-                    ws.send(JSON.stringify({ type: 'unlock', user_id: userId, payload: { field: editingField } }));
+                    ws.send(encodeMessage({ type: 'unlock', user_id: userId, payload: { field: editingField } }));
                     editingField = null;
                 });
 
                 ws.onopen = function() {
-                    ws.send(JSON.stringify({ type: 'fetch_data' }));
+                    ws.send(encodeMessage({ type: 'fetch_data' }));
                 };
             }
 
@@ -131,110 +191,335 @@ html = """
 </html>
 """
 
+class ClientState:
+    # __slots__ keeps per-socket state compact at high connection counts.
+    __slots__ = ("ws", "queue", "writer", "use_msgpack", "locks")
+
+    def __init__(self, ws: WebSocket, queue: asyncio.Queue, writer: asyncio.Task, use_msgpack: bool):
+        self.ws = ws
+        self.queue = queue
+        self.writer = writer
+        self.use_msgpack = use_msgpack
+        self.locks: set = set()
+
 class ConnectionManager:
+    SEND_QUEUE_SIZE = 64
+    SEND_TIMEOUT = 1.0
+    UPDATE_DEBOUNCE = 0.03
+    DB_FLUSH_INTERVAL = 2.0
+    USER_LIST_INTERVAL = 0.1
+
     def __init__(self):
-        self.rooms: Dict[str, Dict[str, WebSocket]] = {}
+        self.rooms: Dict[str, Dict[str, ClientState]] = {}
+        # room_id -> tuple of (user_id, client) pairs, rebuilt on membership
+        # change so broadcast iterates a flat tuple instead of a dict view.
+        self.rooms_snapshot: Dict[str, tuple] = {}
         self.locks: Dict[str, Dict[str, str]] = {}
+        self.form_state: Dict[str, dict] = {}
+        self._dirty_rooms: set = set()
+        self._userlist_dirty: set = set()
+        self._last_user_list: Dict[str, list] = {}
+        self._pending: Dict[str, dict] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        # room_id -> pub/sub listener task (only used with Redis fan-out)
+        self._subscriptions: Dict[str, asyncio.Task] = {}
 
-    async def connect(self, websocket: WebSocket, room_id: str, user_id: str):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, room_id: str, user_id: str) -> ClientState:
+        offered = websocket.scope.get("subprotocols") or []
+        use_msgpack = "msgpack" in offered
+        await websocket.accept(subprotocol="msgpack" if use_msgpack else None)
         if room_id not in self.rooms:
             self.rooms[room_id] = {}
-        self.rooms[room_id][user_id] = websocket
-        await self.broadcast_user_list(room_id)
+        queue = asyncio.Queue(maxsize=self.SEND_QUEUE_SIZE)
+        task = asyncio.create_task(self._writer(room_id, user_id, websocket, queue))
+        client = ClientState(websocket, queue, task, use_msgpack)
+        self.rooms[room_id][user_id] = client
+        self._rebuild_snapshot(room_id)
+        self._userlist_dirty.add(room_id)
+        if redis_client is not None and room_id not in self._subscriptions:
+            self._subscriptions[room_id] = asyncio.create_task(self._subscribe(room_id))
+        return client
+
+    async def _subscribe(self, room_id: str):
+        pubsub = redis_client.pubsub()
+        await pubsub.subscribe(f"room:{room_id}")
+        try:
+            async for msg in pubsub.listen():
+                if msg["type"] != "message":
+                    continue
+                envelope = orjson.loads(msg["data"])
+                message = envelope["message"]
+                if message.get("type") == "update":
+                    # Keep this worker's cache in step with edits made on
+                    # other workers. No dirty mark: the publishing worker
+                    # owns the DB write for these values.
+                    self.form_state.setdefault(room_id, {}).update(message["payload"])
+                self._local_broadcast(room_id, message, envelope["sender_id"])
+        finally:
+            await pubsub.unsubscribe(f"room:{room_id}")
+            await pubsub.aclose()
+
+    def _rebuild_snapshot(self, room_id: str):
+        room = self.rooms.get(room_id)
+        if room:
+            self.rooms_snapshot[room_id] = tuple(room.items())
+        else:
+            self.rooms_snapshot.pop(room_id, None)
 
-    def disconnect(self, room_id: str, user_id: str):
-        if room_id in self.rooms and user_id in self.rooms[room_id]:
-            del self.rooms[room_id][user_id]
-        if not self.rooms[room_id]:
-            del self.rooms[room_id]
+    async def _writer(self, room_id: str, user_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        while True:
+            data = await queue.get()
+            try:
+                await asyncio.wait_for(websocket.send_bytes(data), timeout=self.SEND_TIMEOUT)
+            except Exception:
+                # Stuck or dead peer; evict it rather than buffer forever.
+                asyncio.create_task(self._drop(room_id, user_id))
+                return
+
+    async def _drop(self, room_id: str, user_id: str):
+        client = self.rooms.get(room_id, {}).get(user_id)
+        if client is None:
+            return
+        try:
+            await client.ws.close(code=1011)
+        except Exception:
+            pass
+        await self.disconnect(room_id, user_id)
+
+    async def disconnect(self, room_id: str, user_id: str):
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        client = room.pop(user_id, None)
+        if client is not None:
+            client.writer.cancel()
+        if not room:
+            self.rooms.pop(room_id, None)
+            self._userlist_dirty.discard(room_id)
+            # Forget the last list sent so a future first join broadcasts.
+            self._last_user_list.pop(room_id, None)
+            subscription = self._subscriptions.pop(room_id, None)
+            if subscription is not None:
+                subscription.cancel()
+            if room_id in self._dirty_rooms:
+                # Last member left; persist this worker's unsaved edits.
+                asyncio.create_task(self._flush_room_safe(room_id))
+            else:
+                # Nothing unsaved here — don't overwrite the DB with a
+                # possibly stale snapshot, just drop the cached copy.
+                self.form_state.pop(room_id, None)
+        else:
+            self._userlist_dirty.add(room_id)
+        self._rebuild_snapshot(room_id)
 
-        if room_id in self.locks:
-            fields_to_unlock = [field for field, uid in self.locks[room_id].items() if uid == user_id]
+        fields_to_unlock = client.locks if client is not None else ()
+        room_locks = self.locks.get(room_id)
+        if room_locks:
             for field in fields_to_unlock:
-                del self.locks[room_id][field]
-            if not self.locks[room_id]:
+                if room_locks.get(field) == user_id:
+                    del room_locks[field]
+            if not room_locks:
                 del self.locks[room_id]
+        if fields_to_unlock and room_id in self.rooms:
+            await asyncio.gather(*(self.broadcast_unlock(room_id, field) for field in fields_to_unlock))
 
-    async def broadcast(self, room_id: str, message: str, sender_id: str = None):
-        for user_id, connection in self.rooms.get(room_id, {}).items():
+    async def broadcast(self, room_id: str, message: dict, sender_id: str = None):
+        if redis_client is not None:
+            # Publish once; every worker's subscriber delivers to its own
+            # local sockets. sender_id suppression still works because a
+            # user is connected to exactly one worker.
+            envelope = orjson.dumps({"sender_id": sender_id, "message": message})
+            await redis_client.publish(f"room:{room_id}", envelope)
+            return
+        self._local_broadcast(room_id, message, sender_id)
+
+    def _local_broadcast(self, room_id: str, message: dict, sender_id: str = None):
+        # The message is packed at most once per codec and the same bytes
+        # object is queued for every socket using that codec.
+        payloads: Dict[bool, bytes] = {}
+        for user_id, client in self.rooms_snapshot.get(room_id, ()):
             if sender_id is None or user_id != sender_id:
+                data = payloads.get(client.use_msgpack)
+                if data is None:
+                    data = payloads[client.use_msgpack] = pack_message(message, client.use_msgpack)
                 try:
-                    await connection.send_text(message)
-                except Exception:
-                    pass
+                    client.queue.put_nowait(data)
+                except asyncio.QueueFull:
+                    # Consumer is too slow to keep up; cut it loose.
+                    asyncio.create_task(self._drop(room_id, user_id))
+
+    def queue_update(self, room_id: str, sender_id: str, form_data: dict):
+        pending = self._pending.get(room_id)
+        if pending is None:
+            pending = self._pending[room_id] = {"payload": {}, "sender_id": sender_id}
+        pending["payload"].update(form_data)
+        if pending["sender_id"] != sender_id:
+            # Merged edits from several users; echo the result to everyone.
+            pending["sender_id"] = None
+        if room_id not in self._flush_tasks:
+            self._flush_tasks[room_id] = asyncio.create_task(self._flush_updates(room_id))
+
+    async def _flush_updates(self, room_id: str):
+        await asyncio.sleep(self.UPDATE_DEBOUNCE)
+        self._flush_tasks.pop(room_id, None)
+        pending = self._pending.pop(room_id, None)
+        if not pending or not pending["payload"]:
+            return
+        form_data = pending["payload"]
+        self.form_state.setdefault(room_id, {}).update(form_data)
+        self._dirty_rooms.add(room_id)
+        await self.broadcast(room_id, {"type": "update", "payload": form_data}, sender_id=pending["sender_id"])
+
+    async def load_form_state(self, room_id: str):
+        if room_id not in self.form_state:
+            async with SessionLocal() as db:
+                result = await db.execute(select(FormData).filter_by(id=room_id))
+                form_entry = result.scalar_one_or_none()
+            if form_entry is not None:
+                # A debounced update may have landed during the await;
+                # merge the DB row underneath any live edits, never over.
+                state = {"name": form_entry.name, "email": form_entry.email, "mobile": form_entry.mobile}
+                state.update(self.form_state.get(room_id, {}))
+                self.form_state[room_id] = state
+        return self.form_state.get(room_id)
+
+    async def flush_room(self, room_id: str):
+        self._dirty_rooms.discard(room_id)
+        state = self.form_state.get(room_id)
+        if state:
+            try:
+                async with SessionLocal() as db:
+                    result = await db.execute(select(FormData).filter_by(id=room_id))
+                    form_entry = result.scalar_one_or_none()
+                    if not form_entry:
+                        db.add(FormData(id=room_id, **state))
+                    else:
+                        form_entry.name = state.get('name', form_entry.name)
+                        form_entry.email = state.get('email', form_entry.email)
+                        form_entry.mobile = state.get('mobile', form_entry.mobile)
+                    await db.commit()
+            except Exception:
+                # Transient DB error; restore the flag so flush_loop
+                # retries this room no matter which path called us.
+                self._dirty_rooms.add(room_id)
+                raise
+        if room_id not in self.rooms:
+            self.form_state.pop(room_id, None)
+
+    async def _flush_room_safe(self, room_id: str):
+        try:
+            await self.flush_room(room_id)
+        except Exception:
+            pass  # left dirty by flush_room; retried on the next pass
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.DB_FLUSH_INTERVAL)
+            for room_id in list(self._dirty_rooms):
+                await self._flush_room_safe(room_id)
+
+    async def flush_all(self):
+        for room_id in list(self._dirty_rooms):
+            await self._flush_room_safe(room_id)
 
     async def broadcast_user_list(self, room_id: str):
-        user_list = list(self.rooms[room_id].keys())
-        await self.broadcast(room_id, json.dumps({"type": "user_list", "payload": user_list}))
+        room = self.rooms.get(room_id)
+        if room is None:
+            self._last_user_list.pop(room_id, None)
+            return
+        user_list = list(room.keys())
+        if user_list == self._last_user_list.get(room_id):
+            return
+        self._last_user_list[room_id] = user_list
+        # Built from local membership only; never published to Redis, or
+        # each worker's partial list would overwrite the others'.
+        self._local_broadcast(room_id, {"type": "user_list", "payload": user_list})
+
+    async def user_list_loop(self):
+        while True:
+            await asyncio.sleep(self.USER_LIST_INTERVAL)
+            for room_id in list(self._userlist_dirty):
+                self._userlist_dirty.discard(room_id)
+                await self.broadcast_user_list(room_id)
 
     async def broadcast_lock(self, room_id: str, field: str):
+        # Locks are per-worker state, so lock frames stay local too.
         if room_id in self.locks and field in self.locks[room_id]:
             user_id = self.locks[room_id][field]
-            await self.broadcast(room_id, json.dumps({"type": "lock", "payload": {"field": field, "user_id": user_id}}))
+            self._local_broadcast(room_id, {"type": "lock", "payload": {"field": field, "user_id": user_id}})
 
     async def broadcast_unlock(self, room_id: str, field: str):
-        await self.broadcast(room_id, json.dumps({"type": "unlock", "payload": {"field": field}}))
+        self._local_broadcast(room_id, {"type": "unlock", "payload": {"field": field}})
 
 manager = ConnectionManager()
 
+# Built once at import; the page body and headers never change.
+html_response = HTMLResponse(html)
+
 @app.get("/")
 async def get():
-    return HTMLResponse(html)
+    return html_response
 
 @app.post("/create_form")
 async def create_form():
     form_id = str(uuid.uuid4())
     return JSONResponse(content={"form_id": form_id})
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @app.websocket("/ws/{room_id}/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str, db: Session = Depends(get_db)):
-    await manager.connect(websocket, room_id, user_id)
+async def websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str):
+    client = await manager.connect(websocket, room_id, user_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            raw = await websocket.receive()
+            if raw["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(raw.get("code") or 1000)
+            data = raw["bytes"] if raw.get("bytes") is not None else raw["text"].encode()
+            message = unpack_message(data, client.use_msgpack)
             if message['type'] == 'update':
-                form_data = message['payload']
-                form_entry = db.query(FormData).filter(FormData.id == room_id).first()
-                if not form_entry:
-                    form_entry = FormData(id=room_id, **form_data)
-                    db.add(form_entry)
-                else:
-                    form_entry.name = form_data.get('name', form_entry.name)
-                    form_entry.email = form_data.get('email', form_entry.email)
-                    form_entry.mobile = form_data.get('mobile', form_entry.mobile)
-                db.commit()
-                await manager.broadcast(room_id, json.dumps(message), sender_id=user_id)
+                manager.queue_update(room_id, user_id, message['payload'])
             elif message['type'] == 'fetch_data':
-                form_entry = db.query(FormData).filter(FormData.id == room_id).first()
-                if form_entry:
-                    await websocket.send_text(json.dumps({"type": "update", "payload": {"name": form_entry.name, "email": form_entry.email, "mobile": form_entry.mobile}}))
+                state = await manager.load_form_state(room_id)
+                if state:
+                    await websocket.send_bytes(pack_message({"type": "update", "payload": state}, client.use_msgpack))
             elif message['type'] == 'lock':
                 field = message['payload']['field']
                 if room_id not in manager.locks:
                     manager.locks[room_id] = {}
+                previous = manager.locks[room_id].get(field)
+                if previous is not None and previous != user_id:
+                    previous_client = manager.rooms.get(room_id, {}).get(previous)
+                    if previous_client is not None:
+                        previous_client.locks.discard(field)
                 manager.locks[room_id][field] = user_id
+                client.locks.add(field)
                 await manager.broadcast_lock(room_id, field)
             elif message['type'] == 'unlock':
                 field = message['payload']['field']
                 if room_id in manager.locks and field in manager.locks[room_id]:
-                    del manager.locks[room_id][field]
+                    holder = manager.locks[room_id].pop(field)
+                    holder_client = manager.rooms.get(room_id, {}).get(holder)
+                    if holder_client is not None:
+                        holder_client.locks.discard(field)
                     await manager.broadcast_unlock(room_id, field)
     except WebSocketDisconnect:
-        manager.disconnect(room_id, user_id)
-        await manager.broadcast_user_list(room_id)
+        await manager.disconnect(room_id, user_id)
 
 @app.get("/form/{form_id}")
-async def get_form_data(form_id: str, db: Session = Depends(get_db)):
-    form_entry = db.query(FormData).filter(FormData.id == form_id).first()
+async def get_form_data(form_id: str, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(FormData).filter_by(id=form_id))
+    form_entry = result.scalar_one_or_none()
     if not form_entry:
         raise HTTPException(status_code=404, detail="Form not found")
     return form_entry
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop/httptools swap in the C event loop and HTTP parser; the
+    # websockets protocol implementation negotiates permessage-deflate,
+    # so repeated broadcast payloads are compressed on the wire.
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools",
+                ws="websockets", ws_per_message_deflate=True)